@@ -22,19 +22,22 @@ import basic
 import datetime as dd
 import ham_group
 import html_group
+import json
 import os
 import stat
+import tempfile
 import xml.etree.ElementTree as ET
+from xml.sax import saxutils
 import uuid
 
 ham = {}
-ham['dl_log'] = '/home/smutt/log/fetch_ham.log'
+ham['dl_log'] = ham_group.Ham_group.dl_log
 ham['atom_xml'] = '/home/smutt/www/icannhaz.org/feed.xml'
 ham['link_base'] = 'https://icannhaz.org/ham'
 ham['base_dir'] = ham_group.Ham_group.base_dir
 ham['print_pos'] = 3
 html = {}
-html['dl_log'] = '/home/smutt/log/fetch_html.log'
+html['dl_log'] = html_group.Html_group.dl_log
 html['atom_xml'] = '/home/smutt/www/icannhaz.org/feed_html.xml'
 html['link_base'] = 'https://'
 html['base_dir'] = 'https://'
@@ -43,36 +46,86 @@ conf = [ham, html]
 
 atom_lastrun = '/home/smutt/log/atom_feed.lastrun'
 atom_ns = 'http://www.w3.org/2005/Atom'
+feed_entries = 200 # Newest entries kept in each feed
+store_dir = os.path.expanduser('~') + '/cache/feeds/' # Sidecars holding what each feed is rendered from
 
-# Takes a log filename to read and a minimum timestamp
-# Returns list of new entry lists ==> [timestamp, remote, local]
+# Takes a structured download log to read and a minimum timestamp
+# Only entries logged at or after min_ts are read, see basic.read_downloads()
+# Returns list of new entry lists ==> [timestamp, help_text, remote, local]
 def get_files(fname, min_ts, base_dir):
-  # Returns a 4 tuple (ts, help_text, remote, local) (new)
-  def parse_line(line, base_dir):
-      toks = line.split('||')
-      if len(toks) == 4:
-        return (toks[0].strip(), toks[1].strip(), toks[2].strip(), toks[3].strip())
-      else:
-        return (None, None, None, None)
-
   rv = []
-  with open(fname) as fh:
-    for line in fh:
-      ts, group, remote, local = parse_line(line.strip(), base_dir)
+  for ts, group, remote, local in basic.read_downloads(fname, min_ts):
+    if os.path.exists(local):
+      rv.append([ts, group, remote, local.replace("%", "%25")])
+  return rv
 
-      if ts == None:
-        continue
+# Feed store
+# A feed is rendered from a sidecar JSON file in store_dir instead of being parsed and rewritten
+# The sidecar holds 'head', the serialized <feed> start tag and its children other than entries and <updated>,
+# and 'entries', a list of [title, href, id, updated] oldest first
+# With no usable sidecar the store is built from the existing feed
 
-      try:
-        f_ts = dd.datetime.fromisoformat(ts)
-      except:
-        basic.logit('err: Invalid date encountered in logfile')
-        continue
+# Return the sidecar path for feed (atom_xml)
+def store_file(atom_xml):
+  return store_dir + os.path.basename(atom_xml) + '.json'
 
-      if os.path.exists(local):
-        if min_ts <= f_ts:
-          rv.append([ts, group, remote, local.replace("%", "%25")])
-  return rv
+# Return the store for feed (atom_xml)
+def load_store(atom_xml):
+  try:
+    with open(store_file(atom_xml)) as fh:
+      store = json.load(fh)
+    if not isinstance(store, dict) or not isinstance(store.get('head'), str) or not isinstance(store.get('entries'), list):
+      raise ValueError('unexpected layout')
+    return store
+  except FileNotFoundError:
+    pass
+  except (OSError, ValueError):
+    basic.logit('err: Bad feed store ' + store_file(atom_xml) + ', rebuilding')
+
+  ET.register_namespace('', atom_ns)
+  root = ET.parse(atom_xml).getroot()
+  shell = ET.Element(root.tag, root.attrib)
+  entries = []
+  for el in root:
+    if el.tag == '{' + atom_ns + '}entry':
+      link = el.find('{' + atom_ns + '}link')
+      entries.append([el.findtext('{' + atom_ns + '}title', ''),
+                      '' if link is None else link.get('href', ''),
+                      el.findtext('{' + atom_ns + '}id', ''),
+                      el.findtext('{' + atom_ns + '}updated', '')])
+    elif el.tag != '{' + atom_ns + '}updated':
+      shell.append(el)
+  ET.SubElement(shell, 'end') # Keeps the start tag open when there are no other children
+  ET.indent(shell)
+  head = ET.tostring(shell, encoding='unicode')
+  return {'head': head[:head.rindex('<end')].rstrip(), 'entries': entries}
+
+# Return one entry as Atom XML
+def render_entry(title, href, UID, updated):
+  return "  <entry>\n    <title>" + saxutils.escape(title) + "</title>\n    <link href=" + saxutils.quoteattr(href) + \
+    " />\n    <id>" + saxutils.escape(UID) + "</id>\n    <updated>" + saxutils.escape(updated) + "</updated>\n" + \
+    "    <summary />\n  </entry>\n"
+
+# Write (path) in one go via a temporary file, so readers never see it half written
+def write_file(path, ss):
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+  try:
+    with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+      fh.write(ss)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+  except BaseException:
+    os.unlink(tmp)
+    raise
+
+# Render (store) to feed (atom_xml) and save the store next to it
+def write_feed(atom_xml, store):
+  out = ["<?xml version='1.0' encoding='UTF-8'?>\n", store['head'], '\n  <updated>' + basic.timestamp() + 'Z</updated>\n']
+  out.extend(render_entry(*ee) for ee in store['entries'])
+  out.append('</feed>\n')
+  os.makedirs(store_dir, exist_ok=True)
+  write_file(store_file(atom_xml), json.dumps(store)) # First, so a failed render is redone from it next run
+  write_file(atom_xml, ''.join(out))
 
 ###################
 # BEGIN EXECUTION #
@@ -80,6 +133,8 @@ def get_files(fname, min_ts, base_dir):
 ap = argparse.ArgumentParser(description='Update atom feeds with new documents found.')
 ap.add_argument('-l', '--lastrun', action='store', type=str, help='Use passed lastrun. Do not read or write lastrun from file.')
 ap.add_argument('-d', '--debug', action='store_true', help='Print links to STDOUT. Do not write feed. Do not write lastrun.')
+ap.add_argument('-n', '--entries', type=int, action='store', default=feed_entries,
+                help='Keep this many of the newest entries in each feed. Default: ' + str(feed_entries))
 ARGS = ap.parse_args()
 
 if ARGS.lastrun:
@@ -108,27 +163,17 @@ for cc in conf:
   if len(new_files) == 0:
     continue
 
-  tree = ET.parse(cc['atom_xml'])
-  ET.register_namespace('', atom_ns)
-  tree.find('./{' + atom_ns + '}updated').text = basic.timestamp() + 'Z'
-
+  store = load_store(cc['atom_xml'])
   for nf in new_files:
     title = '[' + nf[1] + '] ' + os.path.basename(nf[cc['print_pos']])
-    UID = str(uuid.uuid5(uuid.NAMESPACE_URL, title)) # uuid.RFC_4122 is broken
-
-    new_entry = "<entry> \
-      \n  <title>" + title + "</title> \
-      \n  <link href=\"" + cc['link_base'] + "/" + nf[cc['print_pos']].split(cc['base_dir'])[1] + "\"/> \
-      \n  <id>urn:uuid:" + UID + "</id> \
-      \n  <updated>" + basic.timestamp() + 'Z' + "</updated> \
-      \n  <summary/> \
-      \n</entry>"
-    tree.find('.').append(ET.fromstring(new_entry))
+    UID = 'urn:uuid:' + str(uuid.uuid5(uuid.NAMESPACE_URL, title)) # uuid.RFC_4122 is broken
+    entry = [title, cc['link_base'] + "/" + nf[cc['print_pos']].split(cc['base_dir'])[1], UID, basic.timestamp() + 'Z']
+    store['entries'].append(entry)
     if ARGS.debug:
-      print(ET.tostring(ET.fromstring(new_entry), encoding='unicode'))
+      print(render_entry(*entry), end='')
 
   if ARGS.debug:
     continue
 
-  ET.indent(tree)
-  tree.write(cc['atom_xml'], xml_declaration=True, encoding='UTF-8')
+  del store['entries'][:-max(1, ARGS.entries)]
+  write_feed(cc['atom_xml'], store)
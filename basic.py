@@ -17,7 +17,12 @@
 #
 #  Copyright (C) 2025 Andrew McConachie, <andrew.mcconachie@icann.org>
 
+import collections
 import datetime as dd
+import fcntl
+import json
+import os
+import threading
 
 # Return the kind of timestamp we like
 # Optionally takes a string in ISO format
@@ -29,3 +34,189 @@ def timestamp(ts=None):
 # Log string (s) to stdout with timestamp
 def logit(s):
   print(timestamp() + ' ' + s.strip())
+
+# Structured download log
+# One JSON record per downloaded file is appended to a log file
+# A sidecar index (log file + '.idx') holds one fixed width line per record: timestamp and byte offset
+# Records are appended in timestamp order, so readers binary search the index to find where to start
+_idx_len = 37 # len('YYYY-MM-DDTHH:MM:SS ') + 16 digit offset + '\n'
+_log_lock = threading.Lock()
+
+# Log a downloaded file
+# Prints the same line logit() always has
+# Unless (log_file) is None, appends a record to it and to the recent downloads ring
+# group => help_text of the group
+# remote => URL the file came from
+# local => where it was written
+def log_download(log_file, group, remote, local):
+  logit('||' + group + '||' + remote + '||' + local)
+  if log_file is None:
+    return
+
+  rec = {'ts': timestamp(), 'group': group, 'remote': remote, 'local': local}
+  with _log_lock: # Bookkeeping only, the file is already in place, so errors are logged and never raised
+    try:
+      with open(log_file, 'ab') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX) # Other processes may share the log
+        try:
+          rec['ts'] = timestamp() # Taken under the lock, so the index stays in order
+          offset = fh.seek(0, os.SEEK_END)
+          fh.write((json.dumps(rec) + '\n').encode('utf-8'))
+          fh.flush()
+          with open(log_file + '.idx', 'ab') as ih:
+            ih.write((rec['ts'] + ' ' + '{:016d}'.format(offset) + '\n').encode('ascii'))
+        finally:
+          fcntl.flock(fh, fcntl.LOCK_UN)
+    except OSError as e:
+      logit('err:dl_log_write:' + log_file + ':' + str(e))
+
+    try:
+      _ring_add([rec])
+    except OSError as e:
+      logit('err:dl_ring_write:' + recent_file + ':' + str(e))
+
+# Read downloads logged by log_download() at or after (min_ts)
+# Only records from the first one at or after min_ts onward are read
+# min_ts => a datetime
+# Yields tuples (ts, group, remote, local)
+def read_downloads(log_file, min_ts):
+  key = min_ts.replace(tzinfo=None).isoformat(timespec='seconds')
+  try:
+    with open(log_file + '.idx', 'rb') as ih:
+      lo = 0
+      hi = os.fstat(ih.fileno()).st_size // _idx_len
+      count = hi
+      while lo < hi:
+        mid = (lo + hi) // 2
+        ih.seek(mid * _idx_len)
+        if ih.read(19).decode('ascii') < key:
+          lo = mid + 1
+        else:
+          hi = mid
+      if lo == count:
+        return
+      ih.seek(lo * _idx_len + 20)
+      offset = int(ih.read(16))
+  except (OSError, ValueError):
+    return
+
+  with open(log_file, 'rb') as fh:
+    fh.seek(offset)
+    for line in fh:
+      try:
+        rec = json.loads(line)
+        yield (rec['ts'], rec['group'], rec['remote'], rec['local'])
+      except (ValueError, KeyError):
+        continue # Torn write
+
+# Recent downloads ring
+# The last recent_slots downloads of every group set, kept for update_html.py
+# A header line 'slots next count' is followed by slots of _slot_len bytes, each one JSON record padded with spaces
+# Writers overwrite the oldest slot in place, so the file never grows
+recent_file = os.path.expanduser('~') + '/log/recent_downloads'
+recent_slots = 100 # update_html.py shows this many at most
+_slot_len = 1024
+_head_len = 27 # len('00000100 00000000 00000000\n')
+
+# Store (recs) in the ring, oldest first, replacing the oldest records once it is full
+# Records too long for a slot are left out
+# seed => only if the ring is not yet full, merge recs with what it holds by timestamp, dropping repeats of a download
+def _ring_add(recs, seed=False):
+  fd = os.open(recent_file, os.O_RDWR | os.O_CREAT, 0o644)
+  with os.fdopen(fd, 'r+b') as fh:
+    fcntl.flock(fh, fcntl.LOCK_EX) # Both group sets write here
+    try:
+      try:
+        slots, nxt, count = [int(tok) for tok in fh.read(_head_len).split()]
+      except ValueError:
+        slots = nxt = count = 0
+      if slots != recent_slots: # New file, or recent_slots changed
+        fh.truncate(0)
+        slots, nxt, count = recent_slots, 0, 0
+
+      if seed:
+        if count >= slots:
+          return
+        held = _ring_records(fh.read(slots * _slot_len), slots, nxt, count)[::-1]
+        merged = {}
+        for rec in recs + held:
+          merged.setdefault((rec['remote'], rec['local']), rec) # Not ts, the log line and the record may differ by a second
+        recs = sorted(merged.values(), key=lambda rec: rec['ts'])[-slots:] # Stable, so ties keep log order
+        fh.truncate(_head_len)
+        nxt = count = 0
+
+      for rec in recs:
+        data = json.dumps(rec).encode('utf-8')
+        if len(data) >= _slot_len:
+          continue
+        fh.seek(_head_len + nxt * _slot_len)
+        fh.write(data.ljust(_slot_len - 1) + b'\n')
+        nxt = (nxt + 1) % slots
+        count = min(count + 1, slots)
+      fh.seek(0)
+      fh.write('{:08d} {:08d} {:08d}\n'.format(slots, nxt, count).encode('ascii'))
+    finally:
+      fcntl.flock(fh, fcntl.LOCK_UN)
+
+# Return the records held in ring (body), newest first
+def _ring_records(body, slots, nxt, count):
+  rv = []
+  for ii in range(count):
+    pos = ((nxt - 1 - ii) % slots) * _slot_len
+    try:
+      rec = json.loads(body[pos:pos + _slot_len])
+      rv.append({'ts': rec['ts'], 'group': rec['group'], 'remote': rec['remote'], 'local': rec['local']})
+    except (ValueError, KeyError):
+      continue
+  return rv
+
+# Fill the ring from the stdout logs of earlier runs until it is full
+# Covers the downloads made before the ring existed
+# Takes log file names, each holding logit() lines, oldest file first
+# Both '||' lines and the older 'ts remote local' lines are understood
+def seed_recent(log_files):
+  if len(recent_downloads()) >= recent_slots:
+    return
+
+  recs = []
+  for fname in log_files:
+    last = collections.deque(maxlen=recent_slots)
+    try:
+      with open(fname, errors='replace') as fh:
+        for line in fh:
+          if '||' in line:
+            toks = line.split('||')
+            if len(toks) == 4:
+              last.append({'ts': toks[0].strip(), 'group': toks[1].strip(), 'remote': toks[2].strip(), 'local': toks[3].strip()})
+          else:
+            toks = line.split()
+            if len(toks) >= 3 and toks[1].startswith('https://'):
+              last.append({'ts': toks[0], 'group': '', 'remote': toks[1], 'local': toks[-1]})
+    except OSError:
+      continue
+    recs.extend(last)
+
+  good = []
+  for rec in recs:
+    try:
+      rec['ts'] = timestamp(rec['ts'])
+      good.append(rec)
+    except ValueError:
+      continue
+  _ring_add(good, seed=True)
+
+# Return up to recent_slots of the most recent downloads, newest first
+# Returns a list of tuples (ts, group, remote, local)
+def recent_downloads():
+  try:
+    with open(recent_file, 'rb') as fh:
+      fcntl.flock(fh, fcntl.LOCK_SH)
+      try:
+        slots, nxt, count = [int(tok) for tok in fh.read(_head_len).split()]
+        body = fh.read(slots * _slot_len)
+      finally:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+  except (OSError, ValueError):
+    return []
+
+  return [(rec['ts'], rec['group'], rec['remote'], rec['local']) for rec in _ring_records(body, slots, nxt, count)]
@@ -26,46 +26,25 @@ import os
 import stat
 
 ham = {}
-ham['dl_log'] = '/home/smutt/log/fetch_ham.log'
+ham['dl_log'] = ham_group.Ham_group.dl_log
 ham['base_dir'] = ham_group.Ham_group.base_dir
 ham['desc'] = 'file'
 html = {}
-html['dl_log'] = '/home/smutt/log/fetch_html.log'
+html['dl_log'] = html_group.Html_group.dl_log
 html['base_dir'] = html_group.Html_group.base_dir
 html['desc'] = 'html'
 conf = [ham, html]
 
 fedi_lastrun = '/home/smutt/log/fedi_feed.lastrun'
 
-# Takes a log filename to read and a minimum timestamp
+# Takes a structured download log to read and a minimum timestamp
+# Only entries logged at or after min_ts are read, see basic.read_downloads()
 # Returns dict of file dicts ==> local_name = {ts, remote_name}
 def get_files(fname, min_ts, base_dir):
-  def parse_line(line, base_dir): # Returns a 3 tuple (ts, remote, local)
-    toks = line.split()
-    if len(toks) == 3:
-      return (toks[0], toks[1], toks[2])
-    elif len(toks) < 3:
-      return (None, None, None)
-    else:
-      start = len(toks[0])
-      end = line.find(base_dir)
-      return (toks[0], line[start:end].strip(), line[end:].strip())
-
   rv = {}
-  with open(fname) as fh:
-    for line in fh:
-      ts, remote, local = parse_line(line.strip(), base_dir)
-      if ts == None:
-        continue
-
-      try:
-        f_ts = dd.datetime.fromisoformat(ts)
-      except:
-        continue
-
-      if os.path.exists(local):
-        if min_ts <= f_ts:
-          rv[local.replace("%", "%25")] = {'ts': ts, 'remote': remote}
+  for ts, _, remote, local in basic.read_downloads(fname, min_ts):
+    if os.path.exists(local):
+      rv[local.replace("%", "%25")] = {'ts': ts, 'remote': remote}
   return rv
 
 ###################
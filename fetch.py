@@ -18,41 +18,139 @@
 #  Copyright (C) 2022, 2024 Andrew McConachie, <andrew.mcconachie@icann.org>
 
 import argparse
+import asyncio
+import basic
+import funk
 import ham_group
 import html_group
+import manifest
 import multiprocessing.pool
+import time
 from urllib import parse as Url_parse
 
+# Should link (ll) be fetched for group (gr)
+# local_files => the dict returned by gr.local_files()
+def is_new(gr, ll, local_files):
+  return not funk.is_local(gr, ll, local_files)
+
+# Download link (ll) for group (gr) and log how long it took
+def timed_download(gr, ll):
+  start = time.monotonic()
+  gr.download(ll)
+  basic.logit('dl_time:' + '{:.2f}'.format(time.monotonic() - start) + 's:' + ll)
+
 # Processes a single group
+# New links are downloaded by up to ARGS.workers threads, capped by the group's max_workers
+# All downloads finish before we return, so groups that are not async_safe still run strictly in turn
 def process_group(gr):
   local_files = gr.local_files()
+  dests = {}
   for ll in gr.get_links():
-    remote_file = gr.remote_file(ll)
-    if remote_file not in local_files and Url_parse.unquote(remote_file) not in local_files \
-      and gr.clean_filename(remote_file) not in local_files:
+    if is_new(gr, ll, local_files):
       if ARGS.debug:
         print(ll)
       else:
-        gr.download(ll)
+        dests.setdefault(gr.clean_filename(gr.remote_file(ll)), ll) # Never write one file twice at once
     else:
       if ARGS.debug:
         print('Skipping ' + ll)
 
+  width = max(1, min(ARGS.workers, gr.max_workers, len(dests)))
+  if width == 1:
+    for ll in dests.values():
+      timed_download(gr, ll)
+  else:
+    with multiprocessing.pool.ThreadPool(processes=width) as mpool:
+      mpool.starmap(timed_download, [(gr, ll) for ll in dests.values()])
+
+# Processes all groups on a single event loop
+# Groups that are not async_safe run one after another in the order passed
+# async_safe groups run concurrently alongside them and download their links concurrently
+# Each group downloads up to ARGS.workers links at once, capped by its max_workers, as in process_group()
+# No more than ARGS.host_limit requests are in flight to any one host
+# The group API (get_links, local_files, remote_file, download) is called in worker threads
+async def crawl(serial_groups, async_groups):
+  host_sems = {}
+  def host_sem(url):
+    host = Url_parse.urlsplit(url).hostname
+    if host not in host_sems:
+      host_sems[host] = asyncio.Semaphore(max(1, ARGS.host_limit))
+    return host_sems[host]
+
+  async def fetch(gr, ll, width):
+    async with width, host_sem(ll):
+      await asyncio.to_thread(timed_download, gr, ll)
+
+  async def run(gr):
+    async with host_sem(gr.uri):
+      links = await asyncio.to_thread(gr.get_links)
+    local_files = await asyncio.to_thread(gr.local_files)
+
+    dests = {}
+    for ll in links:
+      if is_new(gr, ll, local_files):
+        if ARGS.debug:
+          print(ll)
+        else:
+          dests.setdefault(gr.clean_filename(gr.remote_file(ll)), ll) # Never write one file twice at once
+      else:
+        if ARGS.debug:
+          print('Skipping ' + ll)
+
+    width = asyncio.Semaphore(max(1, min(ARGS.workers, gr.max_workers)))
+    if gr.async_safe:
+      await asyncio.gather(*[fetch(gr, ll, width) for ll in dests.values()])
+    else:
+      for ll in dests.values():
+        await fetch(gr, ll, width)
+
+  async def run_serial(grs):
+    for gr in grs:
+      await run(gr)
+
+  await asyncio.gather(run_serial(serial_groups), *[run(gr) for gr in async_groups])
+
 
 ###################
 # BEGIN EXECUTION #
 ###################
 ap = argparse.ArgumentParser(description='Fetch stuff from icann.org. By default fetches all groups in set.')
 ap.add_argument(dest='group_set', choices=['ham', 'html'], help='Set of groups to use')
+ap.add_argument('-a', '--asyncio', action='store_true',
+                help='Run all groups concurrently on one event loop, limiting requests per host. See --host-limit')
 ap.add_argument('-d', '--debug', action='store_true', help='Fetch nothing. Instead print what URLs would be fetched')
 ap.add_argument('-e', '--exclude', type=str, action='store', default=None,
                 help='Fetch all groups except excluded group')
 ap.add_argument('-g', '--group', type=str, action='store', default='all',
                 help='Fetch single group then exit')
+ap.add_argument('--host-limit', type=int, action='store', default=4,
+                help='With --asyncio, max concurrent requests to any one host. Default: 4')
 ap.add_argument('-l', '--list', dest='group_list', action='store_true', help='List groups in set then exit')
+ap.add_argument('-p', '--pool-size', type=int, action='store', default=funk.pool_maxsize,
+                help='Keep-alive connections kept per host. Default: ' + str(funk.pool_maxsize))
+ap.add_argument('-r', '--rate', type=float, action='store', default=funk.rate_limit,
+                help='Max requests per second to any one host. Default: ' + str(funk.rate_limit))
+ap.add_argument('--archiver', choices=['monolith', 'native'], default=html_group.Html_group.archiver,
+                help='How the html set archives pages. Default: ' + html_group.Html_group.archiver)
+ap.add_argument('--burst', type=int, action='store', default=funk.rate_burst,
+                help='Max back to back requests to any one host. Default: ' + str(funk.rate_burst))
+ap.add_argument('--refresh', action='store_true',
+                help='Fetch every child page of two level groups, ignoring pages remembered from earlier runs')
+ap.add_argument('--reconcile', action='store_true',
+                help='Rebuild the local file manifest for the group set from disk then exit')
+ap.add_argument('-s', '--stats', action='store_true',
+                help='After fetching print how many links each include and exclude regex matched')
 ap.add_argument('-u', '--url', type=str, action='store', help='Use passed start URL for group. Requires --group.')
+ap.add_argument('-w', '--workers', type=int, action='store', default=4,
+                help='Download up to this many files at once within a group. Default: 4')
 ARGS = ap.parse_args()
 
+funk.pool_maxsize = max(1, ARGS.pool_size)
+funk.rate_limit = ARGS.rate
+funk.rate_burst = ARGS.burst
+funk.child_refresh = ARGS.refresh
+html_group.Html_group.archiver = ARGS.archiver
+
 if ARGS.group_set == 'ham':
   group_set = ham_group
 elif ARGS.group_set == 'html':
@@ -69,6 +167,11 @@ if ARGS.group_list:
       print(gr + '\t\t || ' + group_set.groups[gr].help_text)
   exit(0)
 
+if ARGS.reconcile:
+  for base_dir in dict.fromkeys([gr.base_dir for gr in group_set.groups.values()]):
+    print(base_dir + ' ' + str(manifest.reconcile(base_dir)) + ' files')
+  exit(0)
+
 if ARGS.exclude != None:
   if ARGS.exclude not in group_set.groups:
     print('Invalid group')
@@ -89,6 +192,7 @@ if ARGS.url:
     exit(1)
   group_set.groups[ARGS.group].uri = ARGS.url
 
+serial_groups = []
 async_groups = []
 for key,gr in group_set.groups.items():
   if ARGS.group != 'all' and ARGS.group != key:
@@ -99,10 +203,21 @@ for key,gr in group_set.groups.items():
 
   if gr.async_safe:
     async_groups.append(gr)
-    continue
+  else:
+    serial_groups.append(gr)
+
+if ARGS.asyncio:
+  asyncio.run(crawl(serial_groups, async_groups))
+else:
+  for gr in serial_groups:
+    process_group(gr)
 
-  process_group(gr)
+  if len(async_groups) > 0:
+    mpool = multiprocessing.pool.ThreadPool(processes=max(1, int(len(async_groups)/3)))
+    mpool.map(process_group, async_groups)
 
-if len(async_groups) > 0:
-  mpool = multiprocessing.pool.ThreadPool(processes=max(1, int(len(async_groups)/3)))
-  mpool.map(process_group, async_groups)
+if ARGS.stats:
+  for mm in funk.matchers():
+    for kind, pattern, hits in mm.stats():
+      print('{:>6} {} {}'.format(hits, kind, pattern))
+    print()
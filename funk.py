@@ -18,15 +18,138 @@
 #  Copyright (C) 2024 Andrew McConachie, <andrew.mcconachie@icann.org>
 
 import basic
-import multiprocessing.pool
+import concurrent.futures
+import email.utils
+import hashlib
+import html.parser
+import json
+import manifest
 import os
 import stat
 import re
 import requests
-from bs4 import BeautifulSoup
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  import sre_parse
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib import parse as Url_parse
 from urllib3 import util as Util
 from datetime import datetime, date
 
+pool_connections = 16 # How many per-host connection pools the shared session keeps
+pool_maxsize = 8 # How many keep-alive connections are kept per host
+rate_limit = 4.0 # Requests per second allowed to any one host
+rate_burst = 8 # Requests allowed back to back to any one host
+max_retries = 3 # How many times a request answered with 429 or 503 is retried
+max_retry_wait = 300 # Longest we honor a Retry-After, in seconds
+max_threads = 8 # Most threads any helper here will start
+page_chunk = 64 * 1024 # Bytes of a listing page fed to the link parser at a time
+page_timeout = 60 # Seconds to wait on a stalled listing page before giving up on it
+child_dir = os.path.expanduser('~') + '/cache/children/' # Where get_child_links() keeps its stores
+child_ttl = 30 * 86400 # Seconds before get_child_links() fetches a child page again
+child_refresh = False # Make get_child_links() fetch every child page
+asset_dir = os.path.expanduser('~') + '/cache/assets/' # Where get_asset() keeps stylesheets and the like
+asset_ttl = 7 * 86400 # Seconds get_asset() trusts a kept asset
+redirect_file = os.path.expanduser('~') + '/cache/redirects.json' # Where real_locations() remembers redirects
+redirect_ttl = 86400 # Seconds real_locations() trusts a remembered redirect
+fan_width = 4 # Most child pages get_child_links() fetches at once
+max_pages = 25 # Most pages of a paginated listing get_paged_links() will walk
+dl_chunk = 1024 * 1024 # Bytes read from the network at a time when downloading
+dl_buffer = 4 * 1024 * 1024 # Bytes buffered in memory before writing downloads to disk
+
+_session = None
+_session_lock = threading.Lock()
+_limiter = None
+
+# Return the process-wide requests.Session
+# Created on first use and shared by every group and thread in a run
+# Each host gets its own keep-alive pool of pool_maxsize connections
+def session():
+  global _session
+  with _session_lock:
+    if _session is None:
+      ss = requests.Session()
+      adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+      ss.mount('http://', adapter)
+      ss.mount('https://', adapter)
+      _session = ss
+  return _session
+
+# Return the process-wide Rate_limiter
+# Created on first use with rate_limit and rate_burst
+def limiter():
+  global _limiter
+  with _session_lock:
+    if _limiter is None:
+      _limiter = Rate_limiter(rate_limit, rate_burst)
+  return _limiter
+
+# Token bucket per host, shared by all threads
+# Each host starts with (burst) tokens which refill at (rate) per second
+# A request takes one token, or waits until one is available
+class Rate_limiter():
+  def __init__(self, rate, burst):
+    self.rate = max(rate, 0.001)
+    self.burst = max(burst, 1)
+    self.lock = threading.Lock()
+    self.buckets = {} # host => [tokens, last refill, blocked until]
+
+  # Block until a request to host is allowed
+  def wait(self, host):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        tokens, last, until = self.buckets.get(host, [self.burst, now, 0])
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if now >= until and tokens >= 1:
+          self.buckets[host] = [tokens - 1, now, until]
+          return
+        self.buckets[host] = [tokens, now, until]
+        delay = max(until - now, (1 - tokens) / self.rate)
+      time.sleep(delay)
+
+  # Hold all requests to host for (seconds)
+  def block(self, host, seconds):
+    with self.lock:
+      now = time.monotonic()
+      tokens, last, until = self.buckets.get(host, [self.burst, now, 0])
+      self.buckets[host] = [0, now, max(until, now + seconds)]
+
+# Convert a Retry-After header value to seconds
+# Takes either delay-seconds or an HTTP-date, returns (default) if neither
+def retry_after(value, default):
+  if value is None:
+    return default
+  try:
+    return min(max_retry_wait, max(0, int(value.strip())))
+  except ValueError:
+    pass
+  try:
+    delta = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    return min(max_retry_wait, max(0, delta))
+  except (TypeError, ValueError):
+    return default
+
+# Wrapper for requests.get() using the shared session
+# Takes the same arguments as requests.get()
+# Every request waits on the per-host rate limiter
+# 429 and 503 responses are retried after Retry-After, holding back every other request to that host
+def get(URI, **kwargs):
+  host = Util.parse_url(URI).host
+  for attempt in range(max_retries + 1):
+    limiter().wait(host)
+    req = session().get(URI, **kwargs)
+    if req.status_code not in (429, 503) or attempt == max_retries:
+      return req
+
+    delay = retry_after(req.headers.get('Retry-After'), min(max_retry_wait, 5 * 2 ** attempt))
+    req.close()
+    basic.logit("err:rate_limited:" + str(req.status_code) + ":" + str(int(delay)) + "s:" + URI)
+    limiter().block(host, delay)
+
 # Grab links in tags matching regex
 # URI => the URI to grab and parse
 # regex => regex for matching the links
@@ -34,32 +157,319 @@ from datetime import datetime, date
 # excludes => a list of compiled regex of links to ignore
 # Returns deduplicated list of links
 def get_links(URI, regex, tags, excludes):
-  links = []
-  url_t = Util.parse_url(URI)
+  values = page_values(URI, tags)
+  if values is None:
+    return []
+  return matcher(regex, excludes).filter(URI, values)
+
+# Walk a paginated listing forward from URI, grabbing links on each page like get_links()
+# URI must carry a page=N query parameter, otherwise only URI is fetched
+# Stops after the first page whose links we all have, an empty page, a repeated page, or max_pages
+# is_known => function taking a link and returning True if it is already in the local archive
+# Returns deduplicated list of links from every page walked
+def get_paged_links(URI, regex, tags, excludes, is_known):
+  rv = []
+  prev = None
+  for page_uri in paged_uris(URI, max_pages):
+    links = get_links(page_uri, regex, tags, excludes)
+    if len(links) == 0 or links == prev: # Past the end, some sites repeat their last page
+      break
+    rv.extend(links)
+    if all(is_known(ll) for ll in links):
+      break
+    prev = links
+  return list(dict.fromkeys(rv))
+
+# Yield up to (count) URIs, counting URI's page=N query parameter up by one each time
+# Yields only URI if it has no page parameter
+def paged_uris(URI, count):
+  mm = re.search(r'([?&]page=)(\d+)', URI)
+  if mm is None:
+    yield URI
+    return
+
+  for ii in range(count):
+    yield URI[:mm.start(2)] + str(int(mm.group(2)) + ii) + URI[mm.end(2):]
+
+# Grab links from each of a list of child pages, like get_links() on each
+# Child pages are remembered in a per-group store on disk, keyed by URL
+# A page in the store younger than child_ttl is not fetched again, unless child_refresh is set
+# The store is thrown away if regex, tags or excludes change
+# pages => list of child page URIs
+# name => name of the group's store
+# Returns deduplicated list of links, in the order of pages
+def get_child_links(pages, regex, tags, excludes, name):
+  fname = child_dir + name + '.json'
+  sig = hashlib.sha1(repr(([reg.pattern for reg in regex], tags, [reg.pattern for reg in excludes])).encode('utf-8')).hexdigest()
+  store = {}
+  try:
+    with open(fname, 'r') as fh:
+      saved = json.load(fh)
+    if saved.get('sig') == sig:
+      store = saved['pages']
+  except (OSError, ValueError):
+    pass
+
+  now = time.time()
+  todo = [page for page in dict.fromkeys(pages)
+          if page not in store or child_refresh or now - store[page][0] > child_ttl]
+  for page, values in zip(todo, fan_out(lambda page: page_values(page, tags), todo)):
+    if values is None: # Try again next run
+      store.pop(page, None)
+    else:
+      store[page] = [now, matcher(regex, excludes).filter(page, values)]
+
+  rv = []
+  kept = {}
+  for page in pages:
+    if page in store:
+      kept[page] = store[page]
+      rv.extend(store[page][1])
+
+  try:
+    os.makedirs(child_dir, exist_ok=True)
+    with open(fname + '.tmp', 'w') as fh:
+      json.dump({'sig': sig, 'pages': kept}, fh)
+    os.replace(fname + '.tmp', fname)
+  except OSError:
+    basic.logit("err:child_store_write:" + fname)
+  return list(dict.fromkeys(rv))
+
+# Call func on every item in (items), up to (width) at a time, on the shared executor
+# Calls made from inside the shared executor run serially so it can never wait on itself
+# Returns list of results in the order of items
+def fan_out(func, items, width=None):
+  items = list(items)
+  width = max(1, min(width or fan_width, max_threads, len(items)))
+  if width == 1 or threading.current_thread().name.startswith(_executor_prefix):
+    return [func(item) for item in items]
+
+  rv = [None] * len(items)
+  pending = {} # Future => index in items
+  for ii, item in enumerate(items):
+    if len(pending) >= width:
+      done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for ff in done:
+        rv[pending.pop(ff)] = ff.result()
+    pending[executor().submit(func, item)] = ii
+  for ff, ii in pending.items():
+    rv[ii] = ff.result()
+  return rv
+
+# Return the process-wide thread pool used by fan_out()
+# Created on first use with max_threads workers
+def executor():
+  global _executor
+  with _session_lock:
+    if _executor is None:
+      _executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix=_executor_prefix)
+  return _executor
+
+_executor = None
+_executor_prefix = 'funk_pool'
+
+# Is (link) already among (local_files) for group (gr)
+# local_files => the dict returned by gr.local_files()
+def is_local(gr, link, local_files):
+  remote_file = gr.remote_file(link)
+  return remote_file in local_files or Url_parse.unquote(remote_file) in local_files \
+    or gr.clean_filename(remote_file) in local_files
+
+# Grab the value of attribute tags[1] from every tags[0] tag in URI
+# Each page is fetched at most once per run, groups sharing a page share the result
+# If a fetch for the same page is already in flight we wait for it rather than sending our own
+# Returns a list of strings, or None if the page could not be fetched
+def page_values(URI, tags):
+  key = URI + ' ' + tags[0] + ' ' + tags[1]
+  with _pages_lock:
+    slot = _pages.get(key)
+    owner = slot is None
+    if owner:
+      slot = _pages[key] = [threading.Event(), None]
+
+  if not owner:
+    slot[0].wait()
+    return slot[1]
+
+  try:
+    slot[1] = _fetch_values(URI, tags, key)
+  finally:
+    if slot[1] is None: # Let later callers try again
+      with _pages_lock:
+        del _pages[key]
+    slot[0].set()
+  return slot[1]
+
+_pages = {} # Pages fetched this run, key => [done Event, values]
+_pages_lock = threading.Lock()
+
+# Fetch URI and return the value of attribute tags[1] from every tags[0] tag
+# Sends a conditional GET when the page is in the page cache
+# On 304 Not Modified the cached values are returned without parsing anything
+# Returns a list of strings, or None if the page could not be fetched
+def _fetch_values(URI, tags, key):
+  entry = _cache_read(key)
+  headers = {}
+  if entry is not None:
+    if entry['etag']:
+      headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+      headers['If-Modified-Since'] = entry['last_modified']
 
   try:
-    req = requests.get(URI)
+    with get(URI, headers=headers, stream=True, timeout=page_timeout) as req:
+      if req.status_code == 304 and entry is not None:
+        _cache_touch(key)
+        return entry['values']
+
+      if req.status_code != 200:
+        return None
+
+      if req.encoding is None:
+        req.encoding = 'utf-8'
+      parser = Link_parser(tags[0], tags[1])
+      for chunk in req.iter_content(chunk_size=page_chunk, decode_unicode=True):
+        parser.feed(chunk)
+      parser.close()
+      values = parser.values
   except requests.RequestException:
     basic.logit("err:req_exception:" + URI)
-    return []
+    return None
+
+  if 'ETag' in req.headers or 'Last-Modified' in req.headers:
+    _cache_write(key, {'key': key, 'url': URI, 'etag': req.headers.get('ETag'),
+                       'last_modified': req.headers.get('Last-Modified'), 'values': values})
+  return values
+
+# Collects the value of one attribute of one tag as HTML is fed in
+# No document tree is built
+# Matches what BeautifulSoup's html.parser gives for tag.get(attr):
+# a valueless attribute is '' and the last of duplicate attributes wins
+class Link_parser(html.parser.HTMLParser):
+  def __init__(self, tag, attr):
+    super().__init__(convert_charrefs=True)
+    self.tag = tag
+    self.attr = attr
+    self.values = []
+
+  def handle_starttag(self, tag, attrs):
+    if tag != self.tag:
+      return
+
+    value = None
+    for key, val in attrs:
+      if key == self.attr:
+        value = '' if val is None else val
+    if value is not None:
+      self.values.append(value)
+
+# Return the body of URI as bytes, or None if it could not be fetched
+# Used for page assets like stylesheets, which are kept in asset_dir for asset_ttl seconds
+def get_asset(URI):
+  fname = asset_dir + hashlib.sha1(URI.encode('utf-8')).hexdigest()
+  try:
+    if time.time() - os.stat(fname).st_mtime <= asset_ttl:
+      with open(fname, 'rb') as fh:
+        return fh.read()
+  except OSError:
+    pass
+
+  try:
+    with get(URI, timeout=30) as req:
+      if req.status_code != 200:
+        basic.logit("err:asset_bad_response:" + URI)
+        return None
+      body = req.content
+  except requests.RequestException:
+    basic.logit("err:asset_req_exception:" + URI)
+    return None
+
+  tmp = fname + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+  try:
+    os.makedirs(asset_dir, exist_ok=True)
+    with open(tmp, 'wb') as fh:
+      fh.write(body)
+    os.replace(tmp, fname)
+  except OSError:
+    basic.logit("err:asset_cache_write:" + URI)
+  return body
+
+# Page cache
+# One JSON file per cached page in cache_dir, named by the hash of its key
+# A file's mtime is the last time the server confirmed it was current
+# Entries older than cache_max_age are ignored and deleted
+# When more than cache_max_entries exist the least recently validated are deleted
+cache_dir = os.path.expanduser('~') + '/cache/pages/'
+cache_max_age = 30 * 86400 # seconds
+cache_max_entries = 2000
+_cache_swept = False
+_cache_lock = threading.Lock()
+
+# Return the filename of a page cache entry
+def _cache_path(key):
+  return cache_dir + hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+# Return a cached entry dict, or None
+def _cache_read(key):
+  fname = _cache_path(key)
+  try:
+    if time.time() - os.stat(fname).st_mtime > cache_max_age:
+      return None
+    with open(fname, 'r') as fh:
+      entry = json.load(fh)
+  except (OSError, ValueError):
+    return None
 
-  if req.status_code == 200:
-    soup = BeautifulSoup(req.text, 'html.parser')
-    for tag in soup.find_all(tags[0]):
-      link = tag.get(tags[1])
-      if link is None:
+  if entry.get('key') != key: # Hash collision or stale format
+    return None
+  return entry
+
+# Mark a cached entry as just validated
+def _cache_touch(key):
+  try:
+    os.utime(_cache_path(key))
+  except OSError:
+    pass
+
+# Write a cache entry atomically then evict if needed
+def _cache_write(key, entry):
+  fname = _cache_path(key)
+  tmp = fname + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(tmp, 'w') as fh:
+      json.dump(entry, fh)
+    os.replace(tmp, fname)
+  except OSError:
+    basic.logit("err:cache_write:" + entry['url'])
+    return
+  _cache_evict()
+
+# Delete expired entries, then the oldest entries above cache_max_entries
+# Runs at most once per process
+def _cache_evict():
+  global _cache_swept
+  with _cache_lock:
+    if _cache_swept:
+      return
+    _cache_swept = True
+
+  entries = []
+  now = time.time()
+  try:
+    for de in os.scandir(cache_dir):
+      if not de.name.endswith('.json'):
         continue
-      if not is_excluded(excludes, link):
-        for reg in regex:
-          if reg.match(link):
-            link = link.split('?')[0] # Strip any trailing garbage
-            if Util.parse_url(link).host is None:
-              links.append(url_t.scheme + '://' + url_t.host + link)
-            elif len(Util.parse_url(link).host) < len('icann.org'): # Relative path missing leading /
-              links.append(url_t.scheme + '://' + url_t.host + '/' + link)
-            else:
-              links.append(link)
-  return list(dict.fromkeys(links))
+      mtime = de.stat().st_mtime
+      if now - mtime > cache_max_age:
+        os.remove(de.path)
+      else:
+        entries.append((mtime, de.path))
+    entries.sort()
+    for _, path in entries[:max(0, len(entries) - cache_max_entries)]:
+      os.remove(path)
+  except OSError:
+    pass
 
 '''
 # Grab a file and write to disk
@@ -83,15 +493,94 @@ def download(uri, fname):
     basic.logit("err:dl_req_exception:" + uri)
 '''
 
+# Create or replace (dst) as a hardlink to (src)
+# Returns True on success, False if the filesystem will not allow it
+def link_file(src, dst):
+  tmp = dst + '.lnk'
+  try:
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+  except OSError:
+    return False
+  return True
+
+# Parse a Content-Length header value
+# Returns an int, or None if missing or invalid
+def content_length(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+# Parse a Content-Range header value like 'bytes 100-999/1000'
+# Returns a tuple (first byte, total length), either of which may be None
+def content_range(value):
+  try:
+    unit, rest = value.split(None, 1)
+    span, total = rest.split('/')
+    start = int(span.split('-')[0])
+  except (AttributeError, ValueError):
+    return (None, None)
+  if unit != 'bytes':
+    return (None, None)
+  return (start, content_length(total))
+
+# Writes a streamed response to disk in large chunks
+# Optionally hashes everything in the file in the same pass, including data already there when appending
+# Keeps byte and time counts so callers can report throughput
+class Download_sink():
+  def __init__(self, fname, mode='wb', hash_name=None):
+    self.hash = None
+    if hash_name:
+      self.hash = hashlib.new(hash_name)
+      if mode == 'ab':
+        with open(fname, 'rb') as fh:
+          for block in iter(lambda: fh.read(dl_chunk), b''):
+            self.hash.update(block)
+    self.fh = open(fname, mode, buffering=dl_buffer)
+    self.bytes = 0
+    self.start = time.monotonic()
+    self.secs = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  # Copy the body of a streamed requests response (req) to disk
+  def write_from(self, req):
+    for chunk in req.iter_content(chunk_size=dl_chunk):
+      if chunk: # filter out keep-alive new chunks
+        self.fh.write(chunk)
+        self.bytes += len(chunk)
+        if self.hash is not None:
+          self.hash.update(chunk)
+
+  def close(self):
+    if not self.fh.closed:
+      self.fh.close()
+      self.secs = time.monotonic() - self.start
+
+  # Hex digest of the whole file, or None if not hashing
+  def digest(self):
+    if self.hash is None:
+      return None
+    return self.hash.hexdigest()
+
+  # Return a log string of bytes written, seconds taken and bytes per second
+  def stats(self):
+    return str(self.bytes) + 'B:' + '{:.2f}'.format(self.secs) + 's:' + \
+      str(int(self.bytes / max(self.secs, 0.001))) + 'B/s'
+
 # Return dict of files existing locally on disk under (path)
 # Whitespaces in files are escaped with %20
+# Answered from the manifest, see manifest.py
 # path => a UNIX path 
 def local_files(path):
-  rv = {}
-  for _, _, files in os.walk(path):
-    for ff in files:
-      rv[ff.strip()] = True
-  return rv
+  return manifest.local_files(path)
 
 # Determine remote filename to compare to local_files
 # Takes a string URL
@@ -108,26 +597,204 @@ def is_excluded(excludes, s):
       return True
   return False
 
+# Return the shared Link_matcher for (regex, excludes)
+# One matcher is built per distinct set of patterns and kept for the run, along with its hit counts
+def matcher(regex, excludes):
+  key = (tuple(regex), tuple(excludes))
+  with _matchers_lock:
+    if key not in _matchers:
+      _matchers[key] = Link_matcher(regex, excludes)
+    return _matchers[key]
+
+# Return every Link_matcher built so far
+def matchers():
+  with _matchers_lock:
+    return list(_matchers.values())
+
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+# Return the literal strings any match of compiled regex (reg) must contain
+# Only literal runs at the top level of the pattern count, anything optional or alternated is skipped
+# Case insensitive patterns return nothing
+def required_literals(reg):
+  if reg.flags & re.IGNORECASE:
+    return []
+  try:
+    parsed = sre_parse.parse(reg.pattern, reg.flags)
+  except Exception:
+    return []
+
+  rv = []
+  run = ''
+  for op, arg in parsed:
+    if op == sre_parse.LITERAL:
+      run += chr(arg)
+    else:
+      if run:
+        rv.append(run)
+      run = ''
+  if run:
+    rv.append(run)
+  return rv
+
+# Decides which links on a page a group wants, and canonicalizes them
+# Behaves like testing each exclude then each include with re.match(), but faster:
+#   - each pattern is skipped unless the link contains all of its required literals
+#   - patterns sharing flags are fused into one alternation, so the regex engine runs once
+# Counts how many links each include accepted and each exclude rejected
+class Link_matcher():
+  def __init__(self, regex, excludes):
+    self.includes = list(regex)
+    self.excludes = list(excludes)
+    self.include_hits = [0] * len(self.includes)
+    self.exclude_hits = [0] * len(self.excludes)
+    self.lock = threading.Lock()
+    self.include_sets = self._fuse(self.includes)
+    self.exclude_sets = self._fuse(self.excludes)
+
+  # Group patterns into [literals by index, compiled alternation or None, member indexes]
+  # Patterns with their own groups are left alone so their group numbers still work
+  @staticmethod
+  def _fuse(patterns):
+    by_flags = {}
+    for ii, reg in enumerate(patterns):
+      if reg.groups == 0:
+        by_flags.setdefault(reg.flags, []).append(ii)
+      else:
+        by_flags.setdefault(('solo', ii), []).append(ii)
+
+    rv = []
+    for flags, members in by_flags.items():
+      fused = None
+      if len(members) > 1:
+        try:
+          fused = re.compile('|'.join('(?P<p' + str(ii) + '>' + patterns[ii].pattern + ')' for ii in members),
+                             patterns[members[0]].flags)
+        except re.error:
+          fused = None
+      if fused is None and len(members) > 1:
+        for ii in members:
+          rv.append([{ii: required_literals(patterns[ii])}, None, [ii]])
+      else:
+        rv.append([{ii: required_literals(patterns[ii]) for ii in members}, fused, members])
+    return rv
+
+  # Return the index of the first pattern in (sets) that matches (link), or None
+  @staticmethod
+  def _first(patterns, sets, link):
+    best = None
+    for literals, fused, members in sets:
+      live = [ii for ii in members if all(lit in link for lit in literals[ii])]
+      if not live:
+        continue
+      if fused is None or len(live) == 1:
+        for ii in live:
+          if patterns[ii].match(link):
+            hit = ii
+            break
+        else:
+          continue
+      else:
+        mm = fused.match(link)
+        if mm is None:
+          continue
+        hit = int(mm.lastgroup[1:])
+      if best is None or hit < best:
+        best = hit
+    return best
+
+  # Is (link) wanted
+  def match(self, link):
+    ii = self._first(self.excludes, self.exclude_sets, link)
+    if ii is not None:
+      with self.lock:
+        self.exclude_hits[ii] += 1
+      return False
+
+    ii = self._first(self.includes, self.include_sets, link)
+    if ii is None:
+      return False
+    with self.lock:
+      self.include_hits[ii] += 1
+    return True
+
+  # Turn a wanted link found on page (URI) into an absolute URL
+  @staticmethod
+  def canonical(url_t, link):
+    link = link.split('?')[0] # Strip any trailing garbage
+    host = Util.parse_url(link).host
+    if host is None:
+      return url_t.scheme + '://' + url_t.host + link
+    elif len(host) < len('icann.org'): # Relative path missing leading /
+      return url_t.scheme + '://' + url_t.host + '/' + link
+    else:
+      return link
+
+  # Takes the page URI and a list of link values found on it
+  # Returns deduplicated list of wanted links
+  def filter(self, URI, values):
+    url_t = Util.parse_url(URI)
+    links = []
+    for link in values:
+      if self.match(link):
+        links.append(self.canonical(url_t, link))
+    return list(dict.fromkeys(links))
+
+  # Return list of (kind, pattern, hits) for every pattern
+  def stats(self):
+    with self.lock:
+      return [('include', reg.pattern, hits) for reg, hits in zip(self.includes, self.include_hits)] + \
+        [('exclude', reg.pattern, hits) for reg, hits in zip(self.excludes, self.exclude_hits)]
+
 # Takes a list of URIs
 # Returns a new list with the real redirected URIs
 # The icann.org webserver hangs forever if you send it an HTTP HEAD request, it's intentionally unimplemented
+# So we send a streamed GET and hang up once the headers are in, never reading the body
+# Results are remembered on disk for redirect_ttl seconds
 def real_locations(URIs):
-  def get_location(URI):
+  cache = {}
+  try:
+    with open(redirect_file, 'r') as fh:
+      cache = json.load(fh)
+  except (OSError, ValueError):
+    pass
+
+  now = time.time()
+  todo = [URI for URI in dict.fromkeys(URIs) if URI not in cache or now - cache[URI][0] > redirect_ttl]
+  for URI, (ok, location) in zip(todo, fan_out(resolve_location, todo, max_threads)):
+    if ok:
+      cache[URI] = [now, location]
+
+  if len(todo) > 0:
+    cache = {key: val for key, val in cache.items() if now - val[0] <= redirect_ttl}
     try:
-      req = requests.get(URI, allow_redirects=True, timeout=2)
-    except requests.RequestException:
-      basic.logit("err:rf:req_exception:" + URI)
-      return
+      os.makedirs(os.path.dirname(redirect_file), exist_ok=True)
+      with open(redirect_file + '.' + str(os.getpid()) + '.tmp', 'w') as fh:
+        json.dump(cache, fh)
+      os.replace(redirect_file + '.' + str(os.getpid()) + '.tmp', redirect_file)
+    except OSError:
+      basic.logit("err:redirect_cache_write:" + redirect_file)
 
-    url_t = Util.parse_url(URI)
-    if len(req.history) > 0:
-      if 'location' in req.history[-1].headers:
-        location = req.history[-1].headers['location']
-        if len(location.strip()) > 0:
-          if location.startswith('http'):
-            return location.strip()
-          else:
-            return url_t.scheme + '://' + url_t.host + location
-
-  mpool = multiprocessing.pool.ThreadPool(processes=max(1, int(len(URIs)/3)))
-  return [URI for URI in mpool.map(get_location, URIs) if URI != None]
+  return [cache[URI][1] for URI in URIs if URI in cache and cache[URI][1] != None]
+
+# Find where URI redirects to
+# Returns a tuple (success, location), location is None if URI does not redirect
+def resolve_location(URI):
+  try:
+    with get(URI, allow_redirects=True, timeout=2, stream=True) as req: # Closing unread drops the body
+      history = req.history
+  except requests.RequestException:
+    basic.logit("err:rf:req_exception:" + URI)
+    return (False, None)
+
+  url_t = Util.parse_url(URI)
+  if len(history) > 0:
+    if 'location' in history[-1].headers:
+      location = history[-1].headers['location']
+      if len(location.strip()) > 0:
+        if location.startswith('http'):
+          return (True, location.strip())
+        else:
+          return (True, url_t.scheme + '://' + url_t.host + location)
+  return (True, None)
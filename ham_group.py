@@ -19,6 +19,7 @@
 
 import basic
 import funk
+import manifest
 import os
 import re
 import requests
@@ -27,10 +28,17 @@ from datetime import date
 
 class Ham_group():
   base_dir = '/var/www/htdocs/icannhaz.org/ham/' # Where the local fun starts
+  max_workers = 8 # Most concurrent downloads within one group
+  part_suffix = '.part' # Appended to files while they download
+  dl_attempts = 3 # Times a download is tried or resumed in one run
+  dl_timeout = 60 # Seconds to wait on a stalled connection
+  dedup = True # Hash downloads and hardlink content we already have, see manifest.py
+  dl_log = os.path.expanduser('~') + '/log/fetch_ham.events' # Structured download log read by the feeds, see basic.log_download()
 
   def __init__(self):
     self.enabled = True
     self.async_safe = True
+    self.paged = False # Walk page=N of uri forward until nothing is new
     self.regex = []
     self.help_text = '' # Help text displayed with the group. Intended to be overridden
 
@@ -50,23 +58,76 @@ class Ham_group():
 
   # Grab a file and write to disk
   # Takes a remote URI and a local filename
+  # Data goes to fname + part_suffix, which is renamed to fname only once complete
+  # An interrupted transfer is resumed with a Range request, now or on a later run
+  # With dedup, a URL already fetched elsewhere is hardlinked instead of fetched,
+  # and new content identical to a file we already have is replaced by a hardlink to it
   def _download(self, url, fname):
     if os.path.exists(fname):
       return
 
-    try:
-      req = requests.get(url, stream=True)
-      if req.status_code == 200:
-        with open(fname, 'wb') as f:
-          for chunk in req.iter_content(chunk_size=1024):
-            if chunk: # filter out keep-alive new chunks
-              f.write(chunk)
-        os.chmod(fname, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 0644
-        basic.logit('||' + self.help_text + '||' + url + '||' + fname)
-      else:
-        basic.logit("err:dl_bad_response:" + url)
-    except requests.RequestException:
-      basic.logit("err:dl_req_exception:" + url)
+    if self.dedup:
+      for src, sha256 in manifest.find_url(url):
+        if funk.link_file(src, fname):
+          manifest.add(fname, url, self.help_text, sha256)
+          basic.log_download(self.dl_log, self.help_text, url, fname)
+          basic.logit('dl_link:' + src + ':' + url)
+          return
+
+    part = fname + self.part_suffix
+    for _ in range(self.dl_attempts):
+      try:
+        have = os.path.getsize(part)
+      except OSError:
+        have = 0
+
+      headers = {'Accept-Encoding': 'identity'} # Byte ranges and lengths must refer to the file itself
+      if have > 0:
+        headers['Range'] = 'bytes=' + str(have) + '-'
+
+      try:
+        with funk.get(url, stream=True, headers=headers, timeout=self.dl_timeout) as req:
+          if req.status_code == 206 and have > 0:
+            start, total = funk.content_range(req.headers.get('Content-Range'))
+            if start != have:
+              os.remove(part)
+              continue
+            mode = 'ab'
+          elif req.status_code == 200:
+            have = 0
+            total = funk.content_length(req.headers.get('Content-Length'))
+            mode = 'wb'
+          elif req.status_code == 416 and have > 0: # Our partial file is no good, start over
+            os.remove(part)
+            continue
+          else:
+            basic.logit("err:dl_bad_response:" + url)
+            return
+
+          with funk.Download_sink(part, mode, 'sha256' if self.dedup else None) as sink:
+            sink.write_from(req)
+
+      except requests.RequestException:
+        basic.logit("err:dl_req_exception:" + url)
+        continue
+
+      if total is not None and os.path.getsize(part) != total:
+        basic.logit("err:dl_short:" + str(os.path.getsize(part)) + "/" + str(total) + ":" + url)
+        continue
+
+      os.chmod(part, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 0644
+      os.replace(part, fname)
+      basic.logit('dl_rate:' + sink.stats() + ':' + url)
+      if sink.digest() is not None:
+        for src, _ in manifest.find_hash(sink.digest()):
+          if os.path.abspath(src) != os.path.abspath(fname) and funk.link_file(src, fname):
+            basic.logit('dl_dedup:' + src + ':' + url)
+            break
+      manifest.add(fname, url, self.help_text, sink.digest())
+      basic.log_download(self.dl_log, self.help_text, url, fname)
+      return
+
+    basic.logit("err:dl_incomplete:" + url)
 
   # Wrapper for funk.local_files()
   def local_files(self):
@@ -81,7 +142,12 @@ class Ham_group():
     return funk.remote_file(URL)
 
   # Wrapper for funk.get_links()
+  # Paged groups walk their listing forward until a page has nothing new, see funk.get_paged_links()
   def get_links(self):
+    if self.paged:
+      local_files = self.local_files()
+      return funk.get_paged_links(self.uri, self.regex, ['a', 'href'], self.exclude,
+                                  lambda ll: funk.is_local(self, ll, local_files))
     return funk.get_links(self.uri, self.regex, ['a', 'href'], self.exclude)
 
   # Converts a dirty filename (fname) to a clean filename
@@ -106,10 +172,8 @@ class Alac(Ham_group):
     self.regex.append(re.compile(r'.*/uploads/advice_statement_document/document/.*\.pdf$'))
 
   def get_links(self):
-    rv = []
-    for doc in funk.get_links(self.uri, self.top_regex, ['a', 'href'], self.exclude):
-      rv.extend(funk.get_links(doc, self.regex, ['option', 'value'], self.exclude))
-    return rv
+    docs = funk.get_links(self.uri, self.top_regex, ['a', 'href'], self.exclude)
+    return funk.get_child_links(docs, self.regex, ['option', 'value'], self.exclude, 'alac')
 
 # ASO Minutes
 class Aso_min(Ham_group):
@@ -185,6 +249,7 @@ class Ccnso(Ham_group):
   def __init__(self):
     super().__init__()
     self.async_safe = False
+    self.paged = True
     self.root_path = 'soac/ccnso'
 
   # Wrapper for local_files()
@@ -275,16 +340,15 @@ class Gac(Ham_group):
     self.option_regex.append(re.compile(r'^/contentMigrated/icann.*-communique\?.*$'))
 
   def get_links(self):
-    rv = []
-    for page in funk.get_links(self.uri, self.option_regex, ['option', 'value'], self.exclude):
-      rv.extend(funk.get_links(page, self.regex, ['a', 'href'], self.exclude))
-    return rv
+    pages = funk.get_links(self.uri, self.option_regex, ['option', 'value'], self.exclude)
+    return funk.get_child_links(pages, self.regex, ['a', 'href'], self.exclude, 'gac')
 
 # Government Engagement Publications
 class Ge(Ham_group):
   def __init__(self):
     super().__init__()
     self.help_text = 'ICANN GE Publications'
+    self.paged = True
     self.path = 'icann/ge/pub'
     self.uri = 'https://www.icann.org/en/government-engagement/publications?page=1'
     self.regex.append(re.compile(r'.*/en/files/government-engagement-ge/.*\.pdf$'))
@@ -475,14 +539,10 @@ class Octo_archive(Ham_group):
     return funk.local_files(self.base_dir + self.path) | funk.local_files(self.base_dir + 'soac/ssac/reports')
 
   def get_links(self):
-    rv = []
-    for ll in super().get_links():
-      if ll.endswith('.pdf'):
-        rv.append(ll)
-      else:
-        for mm in funk.get_links(ll, self.regex2, ['a', 'href'], self.exclude):
-          rv.append(mm)
-    return rv
+    links = super().get_links()
+    pages = [ll for ll in links if not ll.endswith('.pdf')]
+    return [ll for ll in links if ll.endswith('.pdf')] + \
+      funk.get_child_links(pages, self.regex2, ['a', 'href'], self.exclude, 'octo_archive')
 
 # RSSAC Publications
 class Rssac(Ham_group):
@@ -20,13 +20,20 @@
 import basic
 import datetime
 import funk
+import manifest
 import re
+import requests
 import os
+import shutil
 import stat
 import subprocess
+import tempfile
+import threading
+import urllib.parse
 from bs4 import BeautifulSoup
+from urllib3 import util as Util
 
-# Generic exception class for anything monolith related
+# Generic exception class for anything monolith or archiver related
 class MonolithException(Exception):
   pass
 
@@ -34,18 +41,35 @@ class Html_group():
   base_dir = '/var/www/htdocs/icannhaz.org/html/' # Where the local fun starts
   staging_dir = '/home/smutt/staging/html/' # Temporary storage after download
   mono_bin = '/home/smutt/bin/monolith' # monolith binary
+  archiver = 'monolith' # How pages are archived, 'monolith' or 'native'
+  stamp_chunk = 1024 * 1024 # Bytes read at a time by stamp_file()
+  body_tag = re.compile(rb'<body(?:\s[^>]*)?>', flags=re.IGNORECASE)
   html_suffix = '_archive.html' # Local ending for downloaded HTML
+  dl_log = os.path.expanduser('~') + '/log/fetch_html.events' # Structured download log read by the feeds, see basic.log_download()
+  max_workers = 4 # Most concurrent downloads within one group
+  mono_procs = 4 # Most monolith processes running at once, across all groups
+  mono_host_limit = 2 # Most monolith processes fetching from any one host at once
+  mono_timeout = 120 # Seconds before a monolith process is killed
+  _mono_sems = {} # mono_procs => semaphore shared by every group with that limit
+  _host_sems = {}
+  _host_lock = threading.Lock()
 
   def __init__(self):
     self.enabled = True
     self.async_safe = False # TODO: Revisit this
+    self.paged = False # Walk page=N of uri forward until nothing is new
     self.regex = [] # Compiled regex to match to download
     self.exclude = [] # Compiled regex to exclude for all groups
     self.help_text = '' # Help text displayed with the group. Intended to be overridden.
     return
 
   # Wrapper for funk.get_links()
+  # Paged groups walk their listing forward until a page has nothing new, see funk.get_paged_links()
   def get_links(self):
+    if self.paged:
+      local_files = self.local_files()
+      return funk.get_paged_links(self.uri, self.regex, ['a', 'href'], self.exclude,
+                                  lambda ll: funk.is_local(self, ll, local_files))
     return funk.get_links(self.uri, self.regex, ['a', 'href'], self.exclude)
 
   # Wrapper for funk.local_files()
@@ -69,61 +93,200 @@ class Html_group():
     return fname
 
   # Season the soup
+  # Copies the staged file into base_dir, adding a link to the original page right after <body>
+  # The file is streamed through, never parsed, and renamed into place once written
+  # f_in => staged monolith output, defaults to the staging path for url
   # Returns output path
-  def stamp_file(self, url):
-    f_in = self.staging_dir + self.path + '/' + self.convert_filename(url) 
+  def stamp_file(self, url, f_in=None):
+    if f_in is None:
+      f_in = self.staging_dir + self.path + '/' + self.convert_filename(url)
     f_out = self.base_dir + self.path + '/' + self.convert_filename(url)
+    stamp = ("<a href=\"" + url + "\">Original page on icann.org</a>").encode('utf-8')
 
+    tmp = None
     try:
-      with open(f_in, 'r') as pot:
-        with open(f_out, 'w') as bowl:
-          soup = BeautifulSoup(pot, 'html.parser')
-          soup.body.insert(0, "<a href=\"" + url + "\">Original page on icann.org</a>")
-          bowl.write(soup.prettify(formatter=None))
-      os.chmod(f_out, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 0644 
+      fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_out), prefix=os.path.basename(f_out) + '.', suffix='.tmp')
+      with open(f_in, 'rb') as pot:
+        with os.fdopen(fd, 'wb') as bowl:
+          if not self._splice(pot, bowl, stamp):
+            basic.logit("err:stamp_no_body:" + f_in)
+      os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 0644 
+      os.replace(tmp, f_out)
       os.remove(f_in)
       return f_out
 
-    except:
+    except OSError:
       basic.logit("err:stamp_exception:" + f_in)
+      if tmp is not None and os.path.exists(tmp):
+        os.remove(tmp)
       return f_out
 
+  # Copy file object (pot) to (bowl), writing (stamp) right after the opening body tag
+  # Only the tail of the last chunk read is held back, in case a body tag straddles two chunks
+  # Returns True if a body tag was found
+  def _splice(self, pot, bowl, stamp):
+    buf = b''
+    while True:
+      chunk = pot.read(self.stamp_chunk)
+      if not chunk:
+        bowl.write(buf)
+        return False
+
+      buf += chunk
+      mm = self.body_tag.search(buf)
+      if mm is not None:
+        bowl.write(buf[:mm.end()])
+        bowl.write(stamp)
+        bowl.write(buf[mm.end():])
+        shutil.copyfileobj(pot, bowl, self.stamp_chunk)
+        return True
+
+      cut = buf.rfind(b'<')
+      if cut == -1 or buf.find(b'>', cut) != -1 or len(buf) - cut > 65536: # No unfinished tag worth keeping
+        cut = len(buf)
+      bowl.write(buf[:cut])
+      buf = buf[cut:]
+
   # Wrapper for _html_download()
+  # Safe to call from several threads at once, each download is staged in its own file
   def download(self, url):
     try:
-      self._html_download(url, self.staging_dir + self.path + '/')
-    except MonolithException:
-      basic.logit("download failed: " + url)
+      if self.archiver == 'native':
+        out_path = self._native_download(url)
+      else:
+        staged = self._html_download(url, self.staging_dir + self.path + '/')
+        out_path = self.stamp_file(url, staged)
+    except MonolithException as e:
+      basic.logit("download failed: " + url + " " + str(e))
       return
-    out_path = self.stamp_file(url)
-    basic.logit('||' + self.help_text + '||' + url + '||' + out_path)
+    manifest.add(out_path, url, self.help_text)
+    basic.log_download(self.dl_log, self.help_text, url, out_path)
+
+  # Archive url without monolith and write it straight into base_dir
+  # Does what monolith does with our flags, in one fetch and one parse:
+  # stylesheets are inlined from the asset cache, scripts, media and fonts are dropped, links made absolute
+  # The "Original page" link is added in the same pass
+  # Returns output path
+  def _native_download(self, url):
+    try:
+      with funk.get(url, timeout=self.mono_timeout) as req:
+        if req.status_code != 200:
+          raise MonolithException("bad response " + str(req.status_code))
+        soup = BeautifulSoup(req.text, 'html.parser')
+    except requests.RequestException as e:
+      raise MonolithException("request exception " + str(e))
+    if soup.body is None:
+      raise MonolithException("no body")
+
+    for tag in soup.find_all(['script', 'noscript', 'iframe', 'object', 'embed', 'video', 'audio', 'source', 'track']):
+      tag.decompose()
+    for tag in soup.find_all('link'):
+      rel = [rr.lower() for rr in tag.get('rel', [])]
+      if 'stylesheet' in rel and tag.get('href'):
+        css = funk.get_asset(urllib.parse.urljoin(url, tag['href']))
+        if css is None:
+          tag.decompose()
+          continue
+        style = soup.new_tag('style')
+        style.string = self._clean_css(css.decode('utf-8', errors='replace'))
+        tag.replace_with(style)
+      elif 'canonical' not in rel and 'alternate' not in rel:
+        tag.decompose()
+    for tag in soup.find_all('style'):
+      if tag.string:
+        tag.string = self._clean_css(tag.string)
+    for tag in soup.find_all(True):
+      for attr in list(tag.attrs):
+        if attr.lower().startswith('on'):
+          del tag[attr]
+      if tag.name == 'img':
+        tag['src'] = ''
+        for attr in ('srcset', 'data-src', 'data-srcset'):
+          if attr in tag.attrs:
+            del tag[attr]
+      elif tag.name == 'a' and tag.get('href'):
+        tag['href'] = urllib.parse.urljoin(url, tag['href'])
+
+    stamp = soup.new_tag('a', href=url)
+    stamp.string = 'Original page on icann.org'
+    soup.body.insert(0, stamp)
 
-  # Call external program to download and save remote HTML to dest_dir
+    f_out = self.base_dir + self.path + '/' + self.convert_filename(url)
+    try:
+      fd, tmp = tempfile.mkstemp(dir=os.path.dirname(f_out), prefix=os.path.basename(f_out) + '.', suffix='.tmp')
+      with os.fdopen(fd, 'wb') as bowl:
+        bowl.write(soup.encode('utf-8'))
+      os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH) # 0644
+      os.replace(tmp, f_out)
+    except OSError as e:
+      raise MonolithException("write OSError " + str(e))
+    return f_out
+
+  # Strip fonts and external references from a stylesheet, as monolith does with --no-fonts --no-images
+  @staticmethod
+  def _clean_css(css):
+    css = re.sub(r'@font-face\s*{[^}]*}', '', css, flags=re.IGNORECASE)
+    css = re.sub(r'@import[^;]*;', '', css, flags=re.IGNORECASE)
+    return re.sub(r'url\(\s*([\'"]?)(?!data:)[^)]*\)', 'url()', css, flags=re.IGNORECASE)
+
+  # Return the semaphore limiting monolith processes running at once
+  # Groups with the same mono_procs share one, so the limit holds across groups
+  def _mono_sem(self):
+    with self._host_lock:
+      if self.mono_procs not in self._mono_sems:
+        self._mono_sems[self.mono_procs] = threading.BoundedSemaphore(self.mono_procs)
+      return self._mono_sems[self.mono_procs]
+
+  # Return the semaphore limiting monolith processes fetching from the host in url
+  def _host_sem(self, url):
+    host = Util.parse_url(url).host
+    with self._host_lock:
+      if host not in self._host_sems:
+        self._host_sems[host] = threading.BoundedSemaphore(self.mono_host_limit)
+      return self._host_sems[host]
+
+  # Call external program to download and save remote HTML to a new file in dest_dir
+  # Waits for a free slot under mono_procs and mono_host_limit first
+  # Returns the path written
   def _html_download(self, url, dest_dir):
-    out_path = dest_dir + self.convert_filename(url)
-    cmd = self.mono_bin + " --no-video --no-images --no-audio --no-js --no-fonts -o " + out_path + " " + url
     try:
-      proc = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
-      proc.wait(timeout=120) # Give up after 2 minutes
-
-    except subprocess.TimeoutExpired as e:
-      basic.logit("_html_download: subprocess TimeoutExpired" + str(e))
-      raise MonolithException
-    except subprocess.CalledProcessError as e:
-      basic.logit("_html_download: subprocess CallProcessError" + str(e))
-      raise MonolithException
+      fd, out_path = tempfile.mkstemp(dir=dest_dir, prefix=self.convert_filename(url) + '.', suffix='.tmp')
+      os.close(fd)
     except OSError as e:
-      basic.logit("_html_download: subprocess OSError" + str(e))
-      raise MonolithException
-    except subprocess.SubprocessError:
-      basic.logit("_html_download: general subprocess error")
-      raise MonolithException
+      raise MonolithException("staging OSError " + str(e))
+
+    cmd = [self.mono_bin, "--no-video", "--no-images", "--no-audio", "--no-js", "--no-fonts", "-o", out_path, url]
+    err = None
+    with self._host_sem(url), self._mono_sem(): # Host first, so no global slot waits on a busy host
+      try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+          if proc.wait(timeout=self.mono_timeout) != 0:
+            err = "exit " + str(proc.returncode)
+        except subprocess.TimeoutExpired:
+          proc.kill()
+          proc.wait()
+          err = "timed out after " + str(self.mono_timeout) + "s"
+      except OSError as e:
+        err = "subprocess OSError " + str(e)
+      except subprocess.SubprocessError:
+        err = "general subprocess error"
+
+    if err is None:
+      return out_path
+
+    try:
+      os.remove(out_path)
+    except OSError:
+      pass
+    raise MonolithException(err)
 
 # ICANN Announcements
 class Announce(Html_group):
   def __init__(self):
     super().__init__()
     self.help_text = 'ICANN Announcements'
+    self.paged = True
     self.top_path = 'icann/announcements'
     today = datetime.date.today()
     self.path = 'icann/announcements/' + str(today.year)
@@ -201,6 +364,7 @@ class Blog(Html_group):
   def __init__(self):
     super().__init__()
     self.help_text = 'ICANN Blogs'
+    self.paged = True
     self.top_path = 'icann/blog'
     today = datetime.date.today()
     self.path = 'icann/blog/' + str(today.year)
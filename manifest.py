@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+#  The file is part of the icann-dl Project.
+#
+#  The icann-dl Project is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  The icann-dl Project is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#  Copyright (C) 2026 Andrew McConachie, <andrew.mcconachie@icann.org>
+
+# Persistent manifest of the documents we have on disk
+# Downloads add themselves as they are written so local_files() never needs to walk the disk
+# A directory tree is walked once, the first time it is asked about, or when reconcile() is called
+# Files added or removed by hand are not seen until the next reconcile
+#
+# It also keeps per-directory counters (files, 512 byte blocks, OCR'd files) for update_html.py
+# tree_stats() reads a directory again only when its mtime moved, whoever changed it
+
+import basic
+import json
+import os
+import sqlite3
+import threading
+
+db_file = os.path.expanduser('~') + '/cache/manifest.db'
+
+_conn = None
+_lock = threading.Lock()
+
+# Return the shared database connection, creating the schema if needed
+# Callers must hold _lock
+def _db():
+  global _conn
+  if _conn is None:
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    _conn = sqlite3.connect(db_file, timeout=60, check_same_thread=False)
+    _conn.execute('PRAGMA journal_mode=WAL')
+    _conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, fname TEXT, grp TEXT, dir TEXT, \
+      size INTEGER, mtime REAL, url TEXT)')
+    if 'sha256' not in [col[1] for col in _conn.execute('PRAGMA table_info(files)')]:
+      _conn.execute('ALTER TABLE files ADD COLUMN sha256 TEXT')
+    _conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+    _conn.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+    _conn.execute('CREATE INDEX IF NOT EXISTS files_url ON files (url)')
+    _conn.execute('CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, ts TEXT)')
+    _conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, files INTEGER, \
+      blocks INTEGER, ocr INTEGER, subdirs TEXT)')
+    _conn.commit()
+  return _conn
+
+# Normalize a directory path so lookups and prefixes compare cleanly
+def _norm(path):
+  return os.path.normpath(os.path.abspath(path))
+
+# Has (path) or one of its parents been walked into the manifest
+def _is_known(path):
+  for (root,) in _db().execute('SELECT path FROM roots'):
+    if path == root or path.startswith(root.rstrip('/') + '/'):
+      return True
+  return False
+
+# Return dict of files existing locally under (path)
+# Walks the disk first if (path) has never been reconciled
+def local_files(path):
+  path = _norm(path)
+  with _lock:
+    known = _is_known(path)
+  if not known:
+    reconcile(path)
+
+  rv = {}
+  with _lock:
+    rows = _db().execute('SELECT fname FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)',
+                         (path, path.rstrip('/') + '/', path.rstrip('/') + '0')) # '0' sorts right after '/'
+    for (fname,) in rows:
+      rv[fname.strip()] = True
+  return rv
+
+# Record a file we just wrote
+# fname => local path of the file
+# url => where it came from
+# group => help_text of the group that fetched it
+# sha256 => hex digest of its content, if known
+def add(fname, url, group, sha256=None):
+  try:
+    st = os.stat(fname)
+  except OSError:
+    return
+
+  fname = _norm(fname)
+  cur_dir = os.path.dirname(fname)
+  with _lock:
+    db = _db()
+    db.execute('INSERT OR REPLACE INTO files (path, fname, grp, dir, size, mtime, url, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+               (fname, os.path.basename(fname), group, cur_dir, st.st_size, st.st_mtime, url, sha256))
+    db.commit()
+
+# Is (fname) the OCR'd copy of a PDF
+def is_ocr(fname):
+  if fname.endswith('_ocr.pdf'):
+    return 1
+  else:
+    return 0
+
+# Count files, 512 byte blocks and OCR'd files under (root)
+# Directories whose mtime matches our last look are not read again, only stat()ed
+# rescan => read every directory regardless
+# Returns a dict with keys files, blocks and ocr
+def tree_stats(root, rescan=False):
+  rv = {'files': 0, 'blocks': 0, 'ocr': 0}
+  dirs = [_norm(root)]
+  while dirs:
+    cur_dir = dirs.pop()
+    try:
+      mtime = os.stat(cur_dir).st_mtime
+    except OSError:
+      continue
+
+    with _lock:
+      row = _db().execute('SELECT mtime, files, blocks, ocr, subdirs FROM dirs WHERE path = ?', (cur_dir,)).fetchone()
+    if rescan or row is None or row[0] != mtime:
+      row = _scan_dir(cur_dir, mtime)
+      if row is None:
+        continue
+
+    rv['files'] += row[1]
+    rv['blocks'] += row[2]
+    rv['ocr'] += row[3]
+    dirs.extend(os.path.join(cur_dir, dd) for dd in json.loads(row[4]))
+  return rv
+
+# Read one directory and store its counters
+# Returns the stored row (mtime, files, blocks, ocr, subdirs), or None if unreadable
+def _scan_dir(cur_dir, mtime):
+  files = blocks = ocr = 0
+  subdirs = []
+  try:
+    for de in os.scandir(cur_dir):
+      if de.is_dir():
+        subdirs.append(de.name)
+      elif de.is_file():
+        files += 1
+        blocks += de.stat().st_blocks
+        ocr += is_ocr(de.name)
+  except OSError:
+    return None
+
+  row = (mtime, files, blocks, ocr, json.dumps(subdirs))
+  with _lock:
+    db = _db()
+    db.execute('INSERT OR REPLACE INTO dirs (path, mtime, files, blocks, ocr, subdirs) VALUES (?, ?, ?, ?, ?, ?)',
+               (cur_dir,) + row)
+    db.commit()
+  return row
+
+# Return (path, sha256) of files still on disk matching a query on files
+# Only files whose size is unchanged since they were recorded are returned
+def _existing(query, args):
+  with _lock:
+    rows = _db().execute('SELECT path, size, sha256 FROM files WHERE ' + query, args).fetchall()
+  rv = []
+  for path, size, sha256 in rows:
+    try:
+      if os.stat(path).st_size == size:
+        rv.append((path, sha256))
+    except OSError:
+      continue
+  return rv
+
+# Return (path, sha256) of files on disk with content hash (sha256)
+def find_hash(sha256):
+  return _existing('sha256 = ?', (sha256,))
+
+# Return (path, sha256) of hashed files on disk that were downloaded from (url)
+def find_url(url):
+  return _existing('url = ? AND sha256 IS NOT NULL', (url,))
+
+# Rebuild the manifest for everything under (path) from disk
+# Source URLs, groups and hashes already recorded for surviving files are kept
+# A hash is only kept if the file's size and mtime are unchanged
+def reconcile(path):
+  path = _norm(path)
+  rows = []
+  for cur_dir, _, files in os.walk(path):
+    for ff in files:
+      fname = os.path.join(cur_dir, ff)
+      try:
+        st = os.stat(fname)
+      except OSError:
+        continue
+      rows.append((fname, ff, cur_dir, st.st_size, st.st_mtime))
+
+  with _lock:
+    db = _db()
+    prefix = (path.rstrip('/') + '/', path.rstrip('/') + '0')
+    old = {}
+    for fname, grp, url, size, mtime, sha256 in db.execute('SELECT path, grp, url, size, mtime, sha256 FROM files \
+      WHERE dir = ? OR (dir >= ? AND dir < ?)', (path,) + prefix):
+      old[fname] = (grp, url, size, mtime, sha256)
+
+    new = []
+    for fname, ff, cur_dir, size, mtime in rows:
+      grp, url, old_size, old_mtime, sha256 = old.get(fname, (None, None, None, None, None))
+      if size != old_size or mtime != old_mtime:
+        sha256 = None
+      new.append((fname, ff, grp, cur_dir, size, mtime, url, sha256))
+
+    db.execute('DELETE FROM files WHERE dir = ? OR (dir >= ? AND dir < ?)', (path,) + prefix)
+    db.executemany('INSERT OR REPLACE INTO files (path, fname, grp, dir, size, mtime, url, sha256) \
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)', new)
+    db.execute('INSERT OR REPLACE INTO roots (path, ts) VALUES (?, ?)', (path, basic.timestamp()))
+    db.commit()
+  return len(rows)
@@ -38,6 +38,7 @@ ap.add_argument('-l', '--check_locals', type=str, action='store', default=None,
 
 ARGS = ap.parse_args()
 hammy = ham_group.Ham_group()
+hammy.dl_log = None # Scraped files stay out of the feeds
 
 include_regex = [re.compile(r'.*\.' + item + r'$') for item in ARGS.include.split(',')]
 exclude_regex = []
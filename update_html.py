@@ -19,16 +19,22 @@
 
 from datetime import datetime
 import math
+import multiprocessing.pool
 import os
+import argparse
+import re
+import tempfile
+import basic
 import ham_group
 import html_group
+import manifest
 
 www_base = '/var/www/htdocs/icannhaz.org/'
 
 fetch_num = 10 # How many of the last fetches to display on index.html
 fetch_num_more = 100 # How many of the last fetches to display on more_recent.html
-fetch_log = os.environ['HOME'] + '/log/fetch_ham.log'
-fetch_log_prev = os.environ['HOME'] + '/log/fetch_ham.log.1'
+fetch_logs = [os.environ['HOME'] + '/log/' + ff for ff in # Fill the recent downloads ring from these, oldest first
+              ['fetch_ham.log.1', 'fetch_ham.log', 'fetch_html.log.1', 'fetch_html.log']]
 
 index_in =  os.path.dirname(os.path.realpath(__file__)) + '/html/index.html.slug'
 index_out = www_base + 'index.html'
@@ -37,23 +43,24 @@ collections_out = www_base + 'collections.html'
 more_recent_in = os.path.dirname(os.path.realpath(__file__)) + '/html/more_recent.html.slug'
 more_recent_out = www_base + 'more_recent.html'
 
-# High-order func to recursively count files
-# Return f(func(cur_dir)) total
-def count_files(func, cur_dir):
-  rv = 0
-  for dd in os.scandir(cur_dir):
-    if dd.is_dir():
-      rv += count_files(func, cur_dir + '/' + dd.name)
-    elif dd.is_file():
-      rv += func(dd)
-  return rv
-
-# Takes an os.DirEntry
-def is_ocr(de):
-  if de.name.endswith('_ocr.pdf'):
-    return 1
-  else:
-    return 0
+stat_workers = 8 # How many group roots are scanned at once
+placeholder = re.compile(r'@@@([^@\s]+)@@@') # @@@name@@@ in slug files
+
+# Count files, 512 byte blocks and OCR'd files under (root)
+# Only directories changed since the last run are read, see manifest.tree_stats()
+# Returns a dict with keys files, blocks and ocr
+def scan_stats(root):
+  return manifest.tree_stats(root, ARGS.rescan)
+
+# Scan every group root in parallel
+# Takes a dict of group name => root directory
+# Returns a dict of group name => scan_stats() result
+def collect_stats(roots):
+  unique = list(dict.fromkeys(roots.values())) # Groups sharing a root are scanned once
+  mpool = multiprocessing.pool.ThreadPool(processes=max(1, min(stat_workers, len(unique))))
+  results = dict(zip(unique, mpool.map(scan_stats, unique)))
+  mpool.close()
+  return {name: results[root] for name, root in roots.items()}
 
 # Read in our slug files
 # Return string
@@ -63,90 +70,106 @@ def read_in(fname):
   fin.close()
   return rv
 
+# Parse slug (ss) once into literal text and placeholder names
+# Returns a list, literals at even positions and names at odd positions
+def compile_slug(ss):
+  return placeholder.split(ss)
+
+# Fill a compiled slug from dict (values) of name => string in one pass
+# Placeholders with no value are left as they are
+def render(template, values):
+  out = []
+  for ii, seg in enumerate(template):
+    if ii % 2 == 0:
+      out.append(seg)
+    else:
+      out.append(values.get(seg, '@@@' + seg + '@@@'))
+  return ''.join(out)
+
+# Rows of a recent fetches table
+# sep => what goes between the two cells of a row
+def fetch_rows(fetches, sep):
+  return '\n'.join('<tr id=\"rec\"><td id=\"rec\">' + ts + '</td>' + sep + '<td><a href=\'' + linky + '\'>' + \
+    linky.split('/')[-1] + '</a></td></tr>' for ts, linky in fetches)
+
 # Write output HTML
-# Overwrites existing files
+# Left alone if it already holds (ss), so its mtime only moves when the page changes
+# Otherwise replaced in one go via a temporary file
 def write_out(fname, ss):
-  fout = open(fname, 'w')
-  fout.write(ss)
-  fout.close()
+  try:
+    with open(fname, 'r') as fin:
+      if fin.read() == ss:
+        return
+  except FileNotFoundError:
+    pass
+
+  fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.' + os.path.basename(fname) + '.')
+  try:
+    with os.fdopen(fd, 'w') as fout:
+      fout.write(ss)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, fname)
+  except BaseException:
+    os.unlink(tmp)
+    raise
 
 
 ###################
 # BEGIN EXECUTION #
 ###################
-index_output = read_in(index_in)
-collections_output = read_in(collections_in)
-more_recent_output = read_in(more_recent_in)
+ap = argparse.ArgumentParser(description='Regenerate index.html, collections.html and more_recent.html.')
+ap.add_argument('-r', '--rescan', action='store_true', help='Read every directory instead of only those that changed')
+ARGS = ap.parse_args()
+
+index_slug = compile_slug(read_in(index_in))
+collections_slug = compile_slug(read_in(collections_in))
+more_recent_slug = compile_slug(read_in(more_recent_in))
+index_values = {}
+collections_values = {}
 
 total_count = total_MB = total_OCR = 0
 
+roots = {}
 for group_set in [ham_group, html_group]:
   for name, gr in group_set.groups.items():
     try:
       path = gr.top_path
     except:
       path = gr.path
+    roots[(group_set, name)] = gr.base_dir + path
 
-    count = count_files(lambda x: 1, gr.base_dir + path)
-    MB = math.ceil(count_files(lambda x: x.stat().st_blocks, gr.base_dir + path) / 2000)
-    OCR = count_files(is_ocr, gr.base_dir + path)
-    total_count += count
-    total_MB += MB
-    total_OCR += OCR
+for (group_set, name), stats in collect_stats(roots).items():
+  count = stats['files']
+  MB = math.ceil(stats['blocks'] / 2000)
+  OCR = stats['ocr']
+  total_count += count
+  total_MB += MB
+  total_OCR += OCR
 
-    collections_output = collections_output.replace('@@@files-' + name + '@@@', "{:,}".format(count))
-    collections_output = collections_output.replace('@@@size-' + name + '@@@', "{:,}".format(MB))
+  # Names shared between group sets show the first one, the ham group
+  collections_values.setdefault('files-' + name, "{:,}".format(count))
+  collections_values.setdefault('size-' + name, "{:,}".format(MB))
 
-index_output = index_output.replace('@@@files-total@@@', "{:,}".format(total_count))
-index_output = index_output.replace('@@@size-total@@@', "{:,}".format(total_MB))
-index_output = index_output.replace('@@@ocr-total@@@', "{:,}".format(total_OCR))
+index_values['files-total'] = "{:,}".format(total_count)
+index_values['size-total'] = "{:,}".format(total_MB)
+index_values['ocr-total'] = "{:,}".format(total_OCR)
 
-collections_output = collections_output.replace('@@@files-total@@@', "{:,}".format(total_count))
-collections_output = collections_output.replace('@@@size-total@@@', "{:,}".format(total_MB))
-
-# Build list of fetched documents from previous and current log files
-fin = open(fetch_log_prev, 'r')
-fetches = list(fin)
-fin.close()
-fin = open(fetch_log, 'r')
-fetches += list(fin)
-fin.close()
+collections_values['files-total'] = "{:,}".format(total_count)
+collections_values['size-total'] = "{:,}".format(total_MB)
 
+# Build list of fetched documents from the recent downloads ring, see basic.recent_downloads()
+basic.seed_recent(fetch_logs) # Does nothing once the ring is full
 recent_fetches = []
-while (len(recent_fetches) < fetch_num_more) and len(fetches) > 0:
-  line = fetches.pop().strip()
-  if line.find('||') == -1: # Old style: TODO: Delete once we have enough new style entries
-    if not line.split()[1].startswith('https://'):
-      continue
-
-    www_base_parent = '/'.join(www_base.split('/')[:-2]) + '/'
-    ts = datetime.fromisoformat(line.split()[0]).strftime('%a %b %d')
-    escaped = line.split(www_base_parent)[1].replace("%", "%25") # Escape % but mangle path
-    linky = '/'.join(escaped.split('/')[1:])
-    recent_fetches.append([ts, linky])
-
-  else: # New style
-    if not line.split('||')[2].startswith('https://'):
-      continue
-
-    ts = datetime.fromisoformat(line.split('||')[0].strip()).strftime('%a %b %d')
-    linky = line.split('||')[2].replace("%", "%25")
-    recent_fetches.append([ts, linky])
-
-ss = ''
-for ii in range(fetch_num):
-  ss += '<tr id=\"rec\"><td id=\"rec\">' + recent_fetches[ii][0] + '</td> <td><a href=\'' + recent_fetches[ii][1] + '\'>' + \
-  recent_fetches[ii][1].split('/')[-1] + '</a></td></tr>\n'
-index_output = index_output.replace('@@@recent-fetches@@@', ss.strip('\n'))
-
-ss = ''
-for ii in range(fetch_num_more):
-  ss += '<tr id=\"rec\"><td id=\"rec\">' + recent_fetches[ii][0] + '</td><td><a href=\'' + recent_fetches[ii][1] + '\'>' + \
-    recent_fetches[ii][1].split('/')[-1] + '</a></td></tr>\n'
-more_recent_output = more_recent_output.replace('@@@more-recent-fetches@@@', ss.strip('\n'))
+for ts, _, remote, _ in basic.recent_downloads():
+  if len(recent_fetches) == fetch_num_more:
+    break
+  if not remote.startswith('https://'):
+    continue
+  recent_fetches.append([datetime.fromisoformat(ts).strftime('%a %b %d'), remote.replace("%", "%25")])
 
-# Write output HTML
-write_out(index_out, index_output)
-write_out(collections_out, collections_output)
-write_out(more_recent_out, more_recent_output)
+index_values['recent-fetches'] = fetch_rows(recent_fetches[:fetch_num], ' ')
 
+# Write output HTML
+write_out(index_out, render(index_slug, index_values))
+write_out(collections_out, render(collections_slug, collections_values))
+write_out(more_recent_out, render(more_recent_slug, {'more-recent-fetches': fetch_rows(recent_fetches, '')}))